@@ -0,0 +1,63 @@
+import os
+import json
+import contextlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+
+# Before the ingest import: ingest.embedding reads EMBED_BACKEND etc. at import time
+load_dotenv()
+
+from ingest.embedding import DynamicBatcher, encode_vectors, load_model  # noqa: E402
+
+EMBED_MODEL = os.getenv("EMBED_MODEL","sentence-transformers/all-MiniLM-L6-v2")
+EMBED_BATCH = int(os.getenv("EMBED_BATCH","64"))
+EMBED_MAX_BATCH = int(os.getenv("EMBED_MAX_BATCH","128"))
+EMBED_WINDOW_MS = float(os.getenv("EMBED_WINDOW_MS","5"))
+EMBED_SERVER_HOST = os.getenv("EMBED_SERVER_HOST","127.0.0.1")
+EMBED_SERVER_PORT = int(os.getenv("EMBED_SERVER_PORT","8765"))
+
+def make_server(batcher: DynamicBatcher, host: str = EMBED_SERVER_HOST,
+                port: int = EMBED_SERVER_PORT) -> ThreadingHTTPServer:
+    class EmbedHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != "/embed":
+                self.send_error(404)
+                return
+            try:
+                req = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                if not isinstance(req, dict):
+                    raise ValueError("body must be a JSON object")
+                texts = req["texts"]
+                if not isinstance(texts, list) or not all(isinstance(t, str) for t in texts):
+                    raise ValueError("texts must be a list of strings")
+            except (ValueError, KeyError) as e:
+                self.send_error(400, str(e))
+                return
+            try:
+                vecs = batcher.encode(texts, bool(req.get("normalize")))
+            except Exception as e:
+                self.send_error(500, "Embedding failed", f"{type(e).__name__}: {e}")
+                return
+            body = json.dumps(encode_vectors(vecs)).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), EmbedHandler)
+
+def run():
+    batcher = DynamicBatcher(load_model(EMBED_MODEL, url=""), max_batch=EMBED_MAX_BATCH,
+                             window_ms=EMBED_WINDOW_MS, batch_size=EMBED_BATCH)
+    httpd = make_server(batcher)
+    with contextlib.suppress(KeyboardInterrupt):
+        httpd.serve_forever()
+    httpd.server_close()
+
+if __name__ == "__main__":
+    run()
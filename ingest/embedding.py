@@ -0,0 +1,183 @@
+import os
+import json
+import base64
+import platform
+import queue
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import requests
+
+EMBED_BACKEND = os.getenv("EMBED_BACKEND","torch").lower()
+EMBED_URL = os.getenv("EMBED_URL","")
+EMBED_TIMEOUT = int(os.getenv("EMBED_TIMEOUT","120"))
+TORCH_THREADS = int(os.getenv("TORCH_THREADS", str(max(1, (os.cpu_count() or 2)//2))))
+ONNX_CACHE_DIR = Path(os.getenv("ONNX_CACHE_DIR",".onnx_cache"))
+ONNX_FILE = "model_optimized_quantized.onnx"
+
+def _mean_pool(last_hidden: np.ndarray, attention_mask: np.ndarray) -> np.ndarray:
+    mask = attention_mask[..., None].astype(last_hidden.dtype)
+    summed = (last_hidden * mask).sum(axis=1)
+    return summed / np.clip(mask.sum(axis=1), 1e-9, None)
+
+def _l2_normalize(x: np.ndarray) -> np.ndarray:
+    return x / np.clip(np.linalg.norm(x, axis=1, keepdims=True), 1e-12, None)
+
+def _export_onnx(name: str, out_dir: Path):
+    """One-shot export: ONNX graph -> fused graph -> dynamic INT8, all saved under out_dir."""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTOptimizer, ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig, OptimizationConfig
+    from transformers import AutoTokenizer
+    from huggingface_hub import hf_hub_download
+
+    out_dir.mkdir(parents=True, exist_ok=True)
+    ort = ORTModelForFeatureExtraction.from_pretrained(name, export=True)
+    ort.save_pretrained(out_dir)
+    AutoTokenizer.from_pretrained(name).save_pretrained(out_dir)
+
+    ORTOptimizer.from_pretrained(ort).optimize(
+        save_dir=out_dir, optimization_config=OptimizationConfig(optimization_level=2))
+    if platform.machine().lower() in {"arm64","aarch64"}:
+        qconfig = AutoQuantizationConfig.arm64(is_static=False, per_channel=False)
+    else:
+        qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    ORTQuantizer.from_pretrained(out_dir, file_name="model_optimized.onnx").quantize(
+        save_dir=out_dir, quantization_config=qconfig)
+
+    # Keep SentenceTransformer's truncation length so ONNX vectors match the torch ones
+    try:
+        cfg = hf_hub_download(name, "sentence_bert_config.json")
+        (out_dir / "sentence_bert_config.json").write_text(Path(cfg).read_text())
+    except Exception:
+        pass
+
+class OptimSentenceTransformer:
+    """ONNX Runtime (INT8) stand-in for SentenceTransformer with the same encode() call.
+
+    Assumes a mean-pooling model such as all-MiniLM-L6-v2.
+    """
+
+    def __init__(self, name: str, cache_dir: Path = ONNX_CACHE_DIR):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+
+        out_dir = cache_dir / name.replace("/","__")
+        if not (out_dir / ONNX_FILE).exists():
+            _export_onnx(name, out_dir)
+        self.tokenizer = AutoTokenizer.from_pretrained(out_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(out_dir, file_name=ONNX_FILE)
+        cfg = out_dir / "sentence_bert_config.json"
+        self.max_seq_length = json.loads(cfg.read_text())["max_seq_length"] if cfg.exists() else 256
+
+    def encode(self, sentences, batch_size: int = 32, normalize_embeddings: bool = False,
+               convert_to_numpy: bool = True, show_progress_bar: bool = False) -> np.ndarray:
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        out = []
+        for i in range(0, len(sentences), batch_size):
+            enc = self.tokenizer(sentences[i:i+batch_size], padding=True, truncation=True,
+                                 max_length=self.max_seq_length, return_tensors="np")
+            hidden = self.model(**enc).last_hidden_state
+            out.append(_mean_pool(hidden, enc["attention_mask"]))
+        vecs = np.concatenate(out).astype(np.float32) if out else np.zeros((0, 0), dtype=np.float32)
+        if normalize_embeddings and len(vecs):
+            vecs = _l2_normalize(vecs)
+        return vecs[0] if single else vecs
+
+def encode_vectors(vecs: np.ndarray) -> dict:
+    vecs = np.ascontiguousarray(vecs, dtype="<f4")
+    return {"dim": int(vecs.shape[1]) if vecs.ndim == 2 else 0,
+            "data": base64.b64encode(vecs.tobytes()).decode()}
+
+def decode_vectors(body: dict) -> np.ndarray:
+    vecs = np.frombuffer(base64.b64decode(body["data"]), dtype="<f4")
+    return vecs.reshape(-1, body["dim"]) if body["dim"] else vecs.reshape(0, 0)
+
+class DynamicBatcher:
+    """Merges encode requests that arrive within window_ms into one model call (up to max_batch texts)."""
+
+    def __init__(self, model, max_batch: int = 128, window_ms: float = 5, batch_size: int = 64):
+        self.model = model
+        self.max_batch = max_batch
+        self.window = window_ms / 1000
+        self.batch_size = batch_size
+        self._queue = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def encode(self, texts: list[str], normalize: bool = False) -> np.ndarray:
+        slot = {"texts": texts, "normalize": normalize, "done": threading.Event()}
+        self._queue.put(slot)
+        slot["done"].wait()
+        if "error" in slot:
+            raise slot["error"]
+        return slot["vecs"]
+
+    def _run(self):
+        while True:
+            slots = [self._queue.get()]
+            n = len(slots[0]["texts"])
+            deadline = time.monotonic() + self.window
+            while n < self.max_batch:
+                try:
+                    slot = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                slots.append(slot)
+                n += len(slot["texts"])
+            self._encode(slots)
+
+    def _encode(self, slots):
+        try:
+            texts = [t for slot in slots for t in slot["texts"]]
+            vecs = self.model.encode(texts, batch_size=self.batch_size, normalize_embeddings=False,
+                                     convert_to_numpy=True, show_progress_bar=False)
+            vecs = np.asarray(vecs, dtype=np.float32)
+            off = 0
+            for slot in slots:
+                part = vecs[off:off+len(slot["texts"])]
+                off += len(slot["texts"])
+                slot["vecs"] = _l2_normalize(part) if slot["normalize"] and len(part) else part
+        except Exception as e:
+            for slot in slots:
+                slot["error"] = e
+        for slot in slots:
+            slot["done"].set()
+
+class RemoteEmbedder:
+    """Client for embed_server.py with the SentenceTransformer encode() call, so processes share one model."""
+
+    def __init__(self, url: str):
+        self.url = url.rstrip("/") + "/embed"
+        self._local = threading.local()
+
+    def _session(self) -> requests.Session:
+        # Warmup, search and ingest threads each get their own keep-alive session
+        s = getattr(self._local, "session", None)
+        if s is None:
+            s = self._local.session = requests.Session()
+        return s
+
+    def encode(self, sentences, batch_size: int = 32, normalize_embeddings: bool = False,
+               convert_to_numpy: bool = True, show_progress_bar: bool = False) -> np.ndarray:
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+        r = self._session().post(self.url, json={"texts": list(sentences), "normalize": normalize_embeddings},
+                              timeout=EMBED_TIMEOUT)
+        r.raise_for_status()
+        vecs = decode_vectors(r.json())
+        return vecs[0] if single else vecs
+
+def load_model(name: str, url: str = EMBED_URL):
+    if url:
+        return RemoteEmbedder(url)
+    if EMBED_BACKEND == "onnx":
+        return OptimSentenceTransformer(name)
+    import torch
+    from sentence_transformers import SentenceTransformer
+    # Leave cores for extraction workers instead of oversubscribing them
+    torch.set_num_threads(TORCH_THREADS)
+    return SentenceTransformer(name)
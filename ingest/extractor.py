@@ -9,7 +9,7 @@ from .ocr import run_ocr
 USE_OCR = os.getenv("OCR_ENABLED","true").lower()=="true"
 OCR_MAX_PAGES = int(os.getenv("OCR_MAX_PAGES","120"))
 OCR_PAGE_DPI = int(os.getenv("OCR_PAGE_DPI","200"))
-TEXT_EXTS = {".txt",".md",".json",".yml",".yaml",".py",".js",".ts",".c",".cpp",".h",".sh"}
+TEXT_EXTS = {".txt",".md",".log",".csv",".tsv",".json",".yml",".yaml",".py",".js",".ts",".c",".cpp",".h",".sh"}
 IMAGE_EXTS = {".png",".jpg",".jpeg",".tiff",".webp"}
 
 def _read_docx(p: Path) -> str:
@@ -2,6 +2,7 @@ import os
 import io
 import base64
 import hashlib
+import threading
 
 import requests
 from pathlib import Path
@@ -10,6 +11,8 @@ from PIL import Image
 
 ENGINE = os.getenv("OCR_ENGINE","surya").lower()
 CACHE_DIR = Path(os.getenv("OCR_CACHE_DIR","state/ocr_cache"))
+DEEPSEEK_OCR_URL = os.getenv("DEEPSEEK_OCR_URL")
+DEEPSEEK_OCR_MODEL = os.getenv("DEEPSEEK_OCR_MODEL")
 CACHE_DIR.mkdir(parents=True, exist_ok=True)
 
 def _img_sha(img: Image.Image) -> str:
@@ -57,9 +60,18 @@ def ocr_paddle(images: List[Image.Image]) -> str:
         texts.append(txt)
     return "\n\f\n".join(texts)
 
+_local = threading.local()
+
+def _session() -> requests.Session:
+    # One keep-alive session per extraction thread; Session isn't guaranteed thread-safe
+    s = getattr(_local, "session", None)
+    if s is None:
+        s = _local.session = requests.Session()
+    return s
+
 def ocr_deepseek(images: List[Image.Image]) -> str:
-    url = os.getenv("DEEPSEEK_OCR_URL")
-    model = os.getenv("DEEPSEEK_OCR_MODEL")
+    if not DEEPSEEK_OCR_URL:
+        raise RuntimeError("OCR_ENGINE=deepseek needs DEEPSEEK_OCR_URL")
     texts=[]
     for im in images:
         h=_img_sha(im)
@@ -69,8 +81,8 @@ def ocr_deepseek(images: List[Image.Image]) -> str:
             continue
         b = io.BytesIO()
         im.save(b, format="PNG")
-        payload = {"model": model, "prompt": "", "images": [base64.b64encode(b.getvalue()).decode()], "temperature": 0.0, "max_tokens": 4096}
-        data = requests.post(url, json=payload, timeout=120).json()
+        payload = {"model": DEEPSEEK_OCR_MODEL, "prompt": "", "images": [base64.b64encode(b.getvalue()).decode()], "temperature": 0.0, "max_tokens": 4096}
+        data = _session().post(DEEPSEEK_OCR_URL, json=payload, timeout=120).json()
         txt = data.get("choices",[{}])[0].get("text","")
         _cache_put(h, txt)
         texts.append(txt)
@@ -1,118 +1,498 @@
 import os
+import contextlib
 import hashlib
 import json
+import logging
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from pathlib import Path
+from stat import S_ISREG
 
+import numpy as np
 from dotenv import load_dotenv
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 import chromadb
 from chromadb.config import Settings
-from sentence_transformers import SentenceTransformer
-from rapidfuzz import fuzz
+from rapidfuzz import fuzz, process
 from mcp.server import Server
 from mcp.types import TextContent
-from ingest.extractor import read_text_with_ocr as read_text
 
+# Before the ingest imports: ingest.* read their settings (OCR, embedding backend) at import time
 load_dotenv()
 
+from ingest.extractor import TEXT_EXTS, USE_OCR, read_text_with_ocr as read_text  # noqa: E402
+from ingest.embedding import load_model  # noqa: E402
+
 ROOT = Path(os.getenv("ROOT_DIR", ".")).resolve()
-ALLOWED = set(e.strip().lower() for e in os.getenv("ALLOWED_EXTS",".pdf,.txt,.md").split(","))
+ROOT_PREFIX = os.path.join(str(ROOT), "")
+ALLOWED = frozenset(e.strip().lower() for e in os.getenv("ALLOWED_EXTS",".pdf,.txt,.md").split(","))
 CHUNK_SIZE = int(os.getenv("CHUNK_SIZE","3000"))
 CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP","400"))
+# chunk_spans is lazy and would only raise mid-scan, once per file; refuse the config at startup instead
+if CHUNK_OVERLAP >= CHUNK_SIZE:
+    raise ValueError(f"CHUNK_OVERLAP ({CHUNK_OVERLAP}) must be smaller than CHUNK_SIZE ({CHUNK_SIZE})")
 PERSIST_DIR = os.getenv("PERSIST_DIR",".chromadb")
 EMBED_MODEL = os.getenv("EMBED_MODEL","sentence-transformers/all-MiniLM-L6-v2")
-STATE_PATH = Path("state/ingest_state.json")
+EMBED_BATCH = int(os.getenv("EMBED_BATCH","64"))
+EMBED_FLUSH_CHUNKS = int(os.getenv("EMBED_FLUSH_CHUNKS","1024"))
+DEBOUNCE_MS = int(os.getenv("DEBOUNCE_MS","500"))
+DEBOUNCE_MAX_MS = int(os.getenv("DEBOUNCE_MAX_MS","5000"))
+RETRY_DOUBLINGS = 5  # a path that keeps failing is retried at most every 32 * DEBOUNCE_MAX_MS
+INDEX_EVENTS = frozenset({"created", "modified", "deleted", "moved"})
+CHROMA_BATCH = int(os.getenv("CHROMA_BATCH","200"))
+INGEST_WORKERS = max(1, int(os.getenv("INGEST_WORKERS", str(os.cpu_count() or 1))))
+HNSW_M = int(os.getenv("HNSW_M","24"))
+HNSW_CONSTRUCTION_EF = int(os.getenv("HNSW_CONSTRUCTION_EF","200"))
+HNSW_SEARCH_EF = int(os.getenv("HNSW_SEARCH_EF","100"))
+MAX_FILE_BYTES = int(os.getenv("MAX_FILE_MB","80")) * (1<<20)
+HASH_ALGO = os.getenv("HASH_ALGO","sha256").lower()
+HASH_BUF = 4 << 20  # large enough for hashlib to drop the GIL and blake3 to spread across threads
+STATE_PATH = Path("state/ingest_state.db")
+STATE_FLUSH_EVERY = int(os.getenv("STATE_FLUSH_EVERY","256"))
 STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
 
 server = Server("local-rag")
-model = SentenceTransformer(EMBED_MODEL)
+model = None  # loaded on first use by get_model()
+log = logging.getLogger(__name__)
+_MODEL_LOCK = threading.Lock()
+# Held only while embedding and writing Chroma + state; extraction runs outside it, so a watcher
+# batch can parse its files while a long scan is writing
+_INGEST_LOCK = threading.Lock()
 client = chromadb.PersistentClient(path=PERSIST_DIR, settings=Settings(allow_reset=True))
-COLL = client.get_or_create_collection("docs", metadata={"hnsw:space":"cosine"})
+HNSW_PARAMS = {
+    "hnsw:space": "cosine",
+    "hnsw:M": HNSW_M,
+    "hnsw:construction_ef": HNSW_CONSTRUCTION_EF,
+    "hnsw:search_ef": HNSW_SEARCH_EF,
+}
+# What Chroma uses for an HNSW key the collection was created without
+_HNSW_DEFAULTS = {"hnsw:space": "l2", "hnsw:M": 16, "hnsw:construction_ef": 100, "hnsw:search_ef": 10}
+
+def open_collection(client, name: str):
+    """Open name, creating it with HNSW_PARAMS; an existing one keeps the HNSW settings it was created with."""
+    # Chroma copies collection metadata into the index segment only at creation, and the segment
+    # is what the index reads (search_ef included). Passing metadata for an existing collection
+    # would just make its metadata disagree with the index, so it is left alone and a mismatch is logged.
+    for coll in client.list_collections():
+        if coll.name == name:
+            stored = {k: (coll.metadata or {}).get(k, d) for k, d in _HNSW_DEFAULTS.items()}
+            diff = {k: stored[k] for k, v in HNSW_PARAMS.items() if stored[k] != v}
+            if diff:
+                log.warning("Collection %r keeps its HNSW settings %s; HNSW_* apply to new collections only "
+                            "(delete %s to rebuild)", name, diff, PERSIST_DIR)
+            return coll
+    return client.create_collection(name, metadata=HNSW_PARAMS)
+
+COLL = open_collection(client, "docs")
+
+def _hasher():
+    if HASH_ALGO == "blake3":
+        from blake3 import blake3
+        return blake3(max_threads=blake3.AUTO)
+    return hashlib.new(HASH_ALGO)
+
+_hash_buf = threading.local()
 
 def fhash(p: Path) -> str:
-    h = hashlib.sha1()
-    with p.open("rb") as f:
-        for chunk in iter(lambda: f.read(1<<20), b""):
-            h.update(chunk)
+    # readinto a reused buffer rather than mmap: a file truncated while mapped (copytruncate log
+    # rotation, in-place rewrites) raises SIGBUS and would take the whole server down
+    h = _hasher()
+    view = getattr(_hash_buf, "view", None)
+    if view is None:
+        # One buffer per extraction thread, reused across files
+        view = _hash_buf.view = memoryview(bytearray(HASH_BUF))
+    with p.open("rb", buffering=0) as f:
+        while n := f.readinto(view):
+            h.update(view[:n])
     return h.hexdigest()
 
-def load_state():
-    return json.loads(STATE_PATH.read_text()) if STATE_PATH.exists() else {}
+# State lives in SQLite (one row per file) with the dict kept hot in memory per STATE_PATH,
+# so callers persist only the rows they touched instead of rewriting every entry.
+_STATE_LOCK = threading.Lock()
+_STATE_DBS: dict[Path, sqlite3.Connection] = {}
+_STATE_CACHE: dict[Path, dict] = {}
+_STATE_DIRTY: dict[Path, set[str]] = {}
+
+def _state_db() -> sqlite3.Connection:
+    conn = _STATE_DBS.get(STATE_PATH)
+    if conn is None:
+        STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(STATE_PATH, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS state(path TEXT PRIMARY KEY, entry TEXT NOT NULL)")
+        _STATE_DBS[STATE_PATH] = conn
+    return conn
+
+def load_state() -> dict:
+    with _STATE_LOCK:
+        s = _STATE_CACHE.get(STATE_PATH)
+        if s is None:
+            rows = _state_db().execute("SELECT path, entry FROM state") if STATE_PATH.exists() else []
+            s = _STATE_CACHE[STATE_PATH] = {path: json.loads(entry) for path, entry in rows}
+        return s
+
+def save_state(s: dict, paths=None, force: bool = False):
+    """Persist s; with paths, those rows are queued and upserted (or deleted when missing from s)
+    in one transaction once STATE_FLUSH_EVERY are pending or force is set."""
+    with _STATE_LOCK:
+        _STATE_CACHE[STATE_PATH] = s
+        dirty = _STATE_DIRTY.setdefault(STATE_PATH, set())
+        if paths is not None:
+            dirty.update(paths)
+            if not dirty or (not force and len(dirty) < STATE_FLUSH_EVERY):
+                return
+        conn = _state_db()
+        conn.execute("BEGIN")
+        try:
+            if paths is None:
+                conn.execute("DELETE FROM state")
+                rows = list(s.items())
+            else:
+                rows = [(k, s[k]) for k in dirty if k in s]
+                conn.executemany("DELETE FROM state WHERE path = ?", [(k,) for k in dirty if k not in s])
+            conn.executemany("INSERT OR REPLACE INTO state(path, entry) VALUES (?, ?)",
+                             [(k, json.dumps(v)) for k, v in rows])
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        dirty.clear()
 
-def save_state(s):
-    STATE_PATH.write_text(json.dumps(s, indent=2))
+def flush_state(s: dict):
+    """Write every queued state row now."""
+    save_state(s, (), force=True)
+
+def needs_reindex(p: Path, state: dict) -> bool:
+    """Whether p may have changed since it was indexed, by its (size, mtime_ns) signature alone.
+
+    True only means "maybe": prepare_file hashes on the extraction worker and skips the
+    re-embed when the content is what state already records."""
+    entry = state.get(str(p), {})
+    if "hash" not in entry or entry.get("ocr", USE_OCR) != USE_OCR:
+        return True
+    stat = p.stat()
+    return entry.get("size") != stat.st_size or entry.get("mtime_ns") != stat.st_mtime_ns
+
+def chunk_spans(n: int, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    if overlap >= size:
+        raise ValueError(f"chunk overlap ({overlap}) must be smaller than chunk size ({size})")
+    if n == 0:
+        return
+    # Starts form an arithmetic progression; the last one is the first whose window reaches n
+    step = size - overlap
+    last = max(0, -(-(n - size) // step)) * step
+    for i in range(0, last + 1, step):
+        yield i, min(n, i + size)
 
 def chunk_text(text: str, size=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
-    n = len(text)
-    i = 0
-    while i < n:
-        j = min(n, i + size)
+    for i, j in chunk_spans(len(text), size, overlap):
         yield i, j, text[i:j]
-        if j == n:
-            break
-        i = j - overlap
 
-def upsert_file(p: Path, state: dict):
-    if not p.exists() or not p.is_file():
-        return
-    if p.suffix.lower() not in ALLOWED:
-        return
-    if p.stat().st_size > int(os.getenv("MAX_FILE_MB","80")) * (1<<20):
-        return
+@lru_cache(maxsize=64)
+def _read_text_cached(path: str, size: int, mtime_ns: int) -> str:
+    # (size, mtime_ns) in the key means an edited file is simply a cache miss
+    return read_text(Path(path))
 
+def read_text_cached(p: Path) -> str:
+    """Extracted text of p, reusing the last extraction (OCR included) while the file is unchanged."""
+    stat = p.stat()
+    return _read_text_cached(str(p), stat.st_size, stat.st_mtime_ns)
+
+def file_unchanged(p: Path, size: int, mtime_ns: int) -> bool:
+    """Whether p still has the (size, mtime_ns) signature it was read with."""
     try:
-        txt = read_text(p)
-    except Exception:
-        return
-    if not txt.strip():
-        return
+        stat = p.stat()
+    except OSError:
+        return False
+    return stat.st_size == size and stat.st_mtime_ns == mtime_ns
 
-    COLL.delete(where={"path": str(p)})
+def prepare_file(p: Path, known: dict | None = None):
+    """Extract and chunk one file; returns (path, ids, docs, metas, state_entry) or None.
 
+    known is the file's current state entry: when the content hash still matches it, nothing is
+    extracted and ids is None, so flush_batch only records the new signature. Hashing and
+    extraction errors propagate."""
+    if p.suffix.lower() not in ALLOWED:
+        return None
+    try:
+        stat = p.stat()
+    except OSError:
+        return None
+    if not S_ISREG(stat.st_mode) or stat.st_size > MAX_FILE_BYTES:
+        return None
+
+    # Hash (on the extraction worker) before extracting, so hash and text describe the same version
+    digest = fhash(p)
+    touched = (known is not None and known.get("algo") == HASH_ALGO and known.get("hash") == digest
+               and known.get("ocr", USE_OCR) == USE_OCR)
+    # Uncached: a scan would otherwise pin its last 64 full documents in memory
+    txt = "" if touched else read_text(p)
+    if not file_unchanged(p, stat.st_size, stat.st_mtime_ns):
+        # Saved mid-extraction: the hash or text may be of either version; the save's event re-queues it
+        return None
+
+    mtime = int(stat.st_mtime)
+    if touched:
+        # Touched but identical content: remember the new signature, keep the indexed chunks
+        return p, None, [], [], {**known, "mtime": mtime, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    path = str(p)
+    # Short fixed-width ids; the full path lives once per chunk in metadata, as one shared str
+    key = hashlib.blake2b(path.encode(), digest_size=8).hexdigest()
     ids, docs, metas = [], [], []
-    for k,(a,b,seg) in enumerate(chunk_text(txt)):
-        ids.append(f"{p}:{a}-{b}")
-        docs.append(seg)
-        metas.append({"path":str(p), "start":a, "end":b, "mtime": int(p.stat().st_mtime)})
-    if not docs:
+    # Slice each chunk exactly once, straight into the list handed to encode/Chroma
+    for a, b in chunk_spans(len(txt)):
+        ids.append(f"{key}:{a}")
+        docs.append(txt[a:b])
+        metas.append({"path":path, "start":a, "end":b, "mtime": mtime, "mtime_ns": stat.st_mtime_ns})
+    entry = {"hash": digest, "algo": HASH_ALGO, "mtime": mtime,
+             "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if not txt.strip():
+        # Extracted fine but blank: still record the file so scans skip it until its size/mtime
+        # change, instead of re-running extraction on every startup. The OCR setting is kept too,
+        # since enabling OCR can turn a blank scan into text.
+        ids, docs, metas = [], [], []
+        entry["ocr"] = USE_OCR
+    return p, ids, docs, metas, entry
+
+def get_model():
+    """The embedding model, loaded once on first use so tools like rag_stats never wait for torch."""
+    global model
+    if model is None:
+        with _MODEL_LOCK:
+            if model is None:
+                model = load_model(EMBED_MODEL)
+    return model
+
+def embed_documents(docs: list[str]) -> np.ndarray:
+    """Encode docs shortest-first so each forward batch pads to similar lengths; rows keep input order."""
+    order = np.argsort([len(d) for d in docs], kind="stable")
+    enc = get_model().encode([docs[i] for i in order], batch_size=EMBED_BATCH, normalize_embeddings=True,
+                       convert_to_numpy=True, show_progress_bar=False)
+    vecs = np.empty(enc.shape, dtype=np.float32)
+    vecs[order] = enc
+    return vecs
+
+def flush_batch(items, state: dict):
+    """Embed the chunks of many prepared files in one encode call, then replace them in Chroma."""
+    items = [it for it in items if it]
+    if not items:
         return
+    with _INGEST_LOCK:
+        # Items can wait in a BatchedUpserter while the watcher indexes a newer save of the same file;
+        # writing them now would replace the newer chunks, so anything changed since prepare is skipped
+        items = [it for it in items if file_unchanged(it[0], it[4]["size"], it[4]["mtime_ns"])]
+        if not items:
+            return
+        ids, docs, metas, replaced = [], [], [], []
+        for p, i, d, m, _ in items:
+            if i is None:
+                continue  # same content, only the signature moved
+            replaced.append(str(p))
+            ids += i
+            docs += d
+            metas += m
+        if replaced:
+            vecs = embed_documents(docs) if docs else None
+            COLL.delete(where={"path": {"$in": replaced}})
+            # One add per CHROMA_BATCH chunks instead of one per file
+            for a in range(0, len(ids), CHROMA_BATCH):
+                b = a + CHROMA_BATCH
+                COLL.add(ids=ids[a:b], embeddings=vecs[a:b], documents=docs[a:b], metadatas=metas[a:b])
+        for p, _, _, _, entry in items:
+            state[str(p)] = entry
+        save_state(state, [str(it[0]) for it in items])
+
+class BatchedUpserter:
+    """Collects prepared files and flushes them to the index every EMBED_FLUSH_CHUNKS chunks."""
+
+    def __init__(self, state: dict):
+        self.state = state
+        self.items = []
+        self.n_chunks = 0
+
+    def add(self, item):
+        if not item:
+            return
+        self.items.append(item)
+        self.n_chunks += len(item[2])
+        if self.n_chunks >= EMBED_FLUSH_CHUNKS:
+            self.flush()
+
+    def flush(self):
+        flush_batch(self.items, self.state)
+        self.items, self.n_chunks = [], 0
 
-    vecs = model.encode(docs, normalize_embeddings=True)
-    COLL.add(ids=ids, embeddings=vecs.tolist(), documents=docs, metadatas=metas)
+    def __enter__(self):
+        return self
 
-    state[str(p)] = {"hash": fhash(p), "mtime": int(p.stat().st_mtime)}
-    save_state(state)
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.flush()
+        # Rows for files already written to Chroma are persisted even if a later file failed
+        flush_state(self.state)
+
+def upsert_file(p: Path, state: dict):
+    flush_batch([prepare_file(p)], state)
 
 def delete_file(p: Path, state: dict):
-    COLL.delete(where={"path": str(p)})
-    state.pop(str(p), None)
-    save_state(state)
+    with _INGEST_LOCK:
+        COLL.delete(where={"path": str(p)})
+        state.pop(str(p), None)
+        save_state(state, [str(p)])
+
+def _prepared(fut):
+    try:
+        return fut.result()
+    except Exception:
+        # Failures (OCR endpoint down, pdftoppm missing, I/O errors) are not recorded: retried next scan
+        return None
+
+def prepare_files(paths, state: dict | None = None):
+    """Yield prepare_file results in input order while up to INGEST_WORKERS files extract concurrently;
+    with state, files whose content is unchanged are not re-extracted."""
+    # Threads rather than processes: pdftoppm, OCR inference and file reads release the GIL, and
+    # spawned workers would re-import this module (model + Chroma client) on macOS.
+    state = state or {}
+    with ThreadPoolExecutor(max_workers=INGEST_WORKERS) as pool:
+        inflight = deque()
+        for p in paths:
+            inflight.append(pool.submit(prepare_file, p, state.get(str(p))))
+            if len(inflight) >= 2 * INGEST_WORKERS:
+                yield _prepared(inflight.popleft())
+        while inflight:
+            yield _prepared(inflight.popleft())
+
+def allowed_name(name: str) -> bool:
+    """Extension check on a bare file name without splitext's tuple; dotfiles have no extension."""
+    dot = name.rfind(".")
+    return dot > 0 and name[dot:].lower() in ALLOWED
+
+def inside_root(p: Path) -> bool:
+    """Whether p stays under ROOT; paths from the walk/watcher only need resolving when they are symlinks."""
+    return not p.is_symlink() or os.path.realpath(p).startswith(ROOT_PREFIX)
+
+def iter_files(root: Path):
+    """Yield files under root with an ALLOWED extension; dirent types mean no stat per entry."""
+    prefix = os.path.join(os.path.realpath(root), "")
+    stack = [str(root)]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for e in it:
+                if e.is_dir(follow_symlinks=False):
+                    stack.append(e.path)
+                elif allowed_name(e.name) and e.is_file():
+                    # Plain entries are inside root by construction; only a symlink can point out of it
+                    if e.is_symlink() and not os.path.realpath(e.path).startswith(prefix):
+                        continue
+                    yield Path(e.path)
 
 def initial_scan():
     st = load_state()
-    for p in ROOT.rglob("*"):
-        if p.is_file() and p.suffix.lower() in ALLOWED:
-            h = fhash(p)
-            prev = st.get(str(p), {}).get("hash")
-            if h != prev:
-                upsert_file(p, st)
-    save_state(st)
+    todo = (p for p in iter_files(ROOT) if needs_reindex(p, st))
+    with BatchedUpserter(st) as batch:
+        for item in prepare_files(todo, st):
+            batch.add(item)
 
 class Handler(FileSystemEventHandler):
+    """Coalesces bursts of watchdog events per path and indexes them once they go quiet for DEBOUNCE_MS,
+    or after DEBOUNCE_MAX_MS for a path that never goes quiet."""
+
+    def __init__(self, clock=time.monotonic):
+        super().__init__()
+        self._clock = clock
+        self._pending: dict[str, tuple[float, float]] = {}  # path -> (first event, last event)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._failures: dict[str, int] = {}  # path -> consecutive failed attempts
+
+    def start(self):
+        """Start the background sweep that indexes pending paths as they come due."""
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
     def on_any_event(self, event):
-        if event.is_directory:
+        # watchdog 4 also reports opened/closed, which fire on every read, including our own extraction
+        if event.is_directory or event.event_type not in INDEX_EVENTS:
             return
-        p = Path(event.src_path)
-        if p.suffix.lower() not in ALLOWED:
+        now = self._clock()
+        for raw in (event.src_path, getattr(event, "dest_path", "")):
+            if raw and allowed_name(os.path.basename(raw)):
+                with self._lock:
+                    idle = not self._pending
+                    self._pending[raw] = (self._pending.get(raw, (now,))[0], now)
+                # Later events never move the earliest deadline forward, so only the first needs a wake-up
+                if idle:
+                    self._wake.set()
+
+    def _next_deadline(self) -> float | None:
+        with self._lock:
+            return min((min(last + DEBOUNCE_MS / 1000, first + DEBOUNCE_MAX_MS / 1000)
+                        for first, last in self._pending.values()), default=None)
+
+    def _run(self):
+        # Sleeps until the earliest pending path is due; with nothing pending it blocks without waking
+        while True:
+            deadline = self._next_deadline()
+            timeout = None if deadline is None else max(0.0, deadline - self._clock())
+            self._wake.wait(timeout)
+            self._wake.clear()
+            self.process_due()
+
+    def process_due(self, now: float | None = None):
+        now = self._clock() if now is None else now
+        quiet, overdue = now - DEBOUNCE_MS / 1000, now - DEBOUNCE_MAX_MS / 1000
+        with self._lock:
+            due = [raw for raw, (first, last) in self._pending.items() if last <= quiet or first <= overdue]
+            for raw in due:
+                del self._pending[raw]
+        if not due:
             return
-        st = load_state()
-        if event.event_type in {"created","modified"} and p.exists():
-            h = fhash(p)
-            if st.get(str(p), {}).get("hash") != h:
-                upsert_file(p, st)
-        elif event.event_type == "deleted":
-            delete_file(p, st)
+        # The file's current state decides, not the last event type: a coalesced
+        # delete+create burst (editor atomic save) must end up indexed.
+        failed = set()
+        batch = None
+        try:
+            st = load_state()
+            with BatchedUpserter(st) as batch:
+                for raw in due:
+                    p = Path(raw)
+                    try:
+                        if p.is_file() and inside_root(p):
+                            if needs_reindex(p, st):
+                                batch.add(prepare_file(p, st.get(raw)))
+                        elif raw in st:
+                            delete_file(p, st)
+                    except Exception:
+                        # One unreadable file must not hold back the rest of its batch
+                        log.exception("Indexing %s failed; retrying", raw)
+                        failed.add(raw)
+        except Exception:
+            # Embedding or the Chroma write failed: every file still waiting in the batch is retried
+            log.exception("Indexing %d changed path(s) failed; retrying", len(due))
+            failed.update(due if batch is None else (str(it[0]) for it in batch.items))
+        self._retry(failed, set(due) - failed, now)
+
+    def _retry(self, failed, done, now: float):
+        # Losing the thread would silently stop all watching, so failures are re-queued instead,
+        # backing off from DEBOUNCE_MAX_MS and doubling per consecutive failure of the same path
+        with self._lock:
+            for raw in failed:
+                n = self._failures[raw] = self._failures.get(raw, 0) + 1
+                t = now + DEBOUNCE_MAX_MS / 1000 * 2 ** min(n - 1, RETRY_DOUBLINGS) - DEBOUNCE_MS / 1000
+                # Queued as if last touched at t, so the path is due once it has been quiet until now+delay;
+                # a fresh event on it during the wait wins
+                self._pending.setdefault(raw, (t, t))
+            for raw in done:
+                self._failures.pop(raw, None)
 
 @server.tool()
 def rag_stats() -> TextContent:
@@ -121,39 +501,73 @@ def rag_stats() -> TextContent:
 
 @server.tool()
 def rag_reindex(paths: list[str] | None = None) -> TextContent:
-    st = load_state()
     if not paths:
         initial_scan()
         return TextContent(text="Reindexed all changed files.")
+    files = []
     for raw in paths:
         p = Path(raw)
         if p.is_dir():
-            for f in p.rglob("*"):
-                if f.is_file():
-                    upsert_file(f, st)
+            files.extend(iter_files(p))
         elif p.is_file():
-            upsert_file(p, st)
+            files.append(p)
+    st = load_state()
+    with BatchedUpserter(st) as batch:
+        for item in prepare_files(files):
+            batch.add(item)
     return TextContent(text=f"Reindexed {len(paths)} path(s).")
 
+@lru_cache(maxsize=4096)
+def _embed_query(model_name: str, query: str) -> np.ndarray:
+    # model_name is part of the key so a model swap never serves stale vectors
+    vec = get_model().encode([query], normalize_embeddings=True, convert_to_numpy=True)[0].astype(np.float32)
+    vec.setflags(write=False)
+    return vec
+
+def chunk_heads(ids: list[str], metas: list[dict], n: int = 800) -> list[str]:
+    """First n chars of each hit: plain-text sources are re-read from disk if unchanged, the rest come from Chroma."""
+    heads = [None]*len(ids)
+    for i, m in enumerate(metas):
+        p = Path(m["path"])
+        if p.suffix.lower() not in TEXT_EXTS:
+            continue
+        try:
+            if p.stat().st_mtime_ns == m.get("mtime_ns"):
+                end = min(m["end"], m["start"]+n)
+                # Same text mode as read_text for TEXT_EXTS, so character offsets line up; only the prefix is read
+                with open(p, errors="ignore") as f:
+                    heads[i] = f.read(end)[m["start"]:]
+        except OSError:
+            pass
+    missing = [ids[i] for i, h in enumerate(heads) if h is None]
+    if missing:
+        got = COLL.get(ids=missing, include=["documents"])
+        docs = dict(zip(got["ids"], got["documents"]))
+        heads = [docs.get(ids[i], "")[:n] if h is None else h for i, h in enumerate(heads)]
+    return heads
+
 @server.tool()
 def rag_search(query: str, k: int = 6, path_filter: str | None = None) -> TextContent:
     where = {"path": {"$contains": path_filter}} if path_filter else None
-    qvec = model.encode([query])[0].tolist()
-    res = COLL.query(query_embeddings=[qvec], n_results=k, where=where, include=["documents","metadatas","distances"])
+    qvec = _embed_query(EMBED_MODEL, " ".join(query.split()))
+    res = COLL.query(query_embeddings=qvec[None, :], n_results=k, where=where, include=["metadatas","distances"])
     items=[]
-    if res.get("ids"):
-        for i in range(len(res["ids"][0])):
-            meta = res["metadatas"][0][i]
-            doc = res["documents"][0][i]
-            score = 1 - float(res["distances"][0][i])
-            score = 0.8*score + 0.2*(fuzz.partial_ratio(query, doc[:800])/100)
-            items.append({
-                "path": meta["path"],
-                "score": round(score,4),
-                "start": meta["start"],
-                "end": meta["end"],
-                "preview": doc[:500].replace("\n"," ")
-            })
+    if res.get("ids") and res["ids"][0]:
+        metas = res["metadatas"][0]
+        docs = chunk_heads(res["ids"][0], metas)
+        # Score every hit in one native call (GIL released, internal thread pool)
+        lexical = process.cdist([query], docs,
+                                scorer=fuzz.partial_ratio, workers=-1)[0] / 100
+        # float64 so the rounded scores serialize as e.g. 0.7013, not float32 noise
+        scores = 0.8*(1 - np.asarray(res["distances"][0], dtype=np.float64)) + 0.2*lexical.astype(np.float64)
+        order = np.argsort(-scores, kind="stable")
+        items = [{
+            "path": metas[i]["path"],
+            "score": score,
+            "start": metas[i]["start"],
+            "end": metas[i]["end"],
+            "preview": docs[i][:500].replace("\n"," ")
+        } for i, score in zip(order.tolist(), np.round(scores[order], 4).tolist())]
     return TextContent(text=json.dumps({"query": query, "results": items}, indent=2))
 
 @server.tool()
@@ -162,7 +576,7 @@ def rag_get(path: str, start: int | None = None, end: int | None = None, window:
     if not p.exists():
         return TextContent(text=json.dumps({"error":"not found"}))
     try:
-        txt = read_text(p)
+        txt = read_text_cached(p)
     except Exception as e:
         return TextContent(text=json.dumps({"error": str(e)}))
     if start is None and end is None:
@@ -178,22 +592,29 @@ def rag_get(path: str, start: int | None = None, end: int | None = None, window:
 @server.tool()
 def rag_invalidate(path: str) -> TextContent:
     p = Path(path)
-    COLL.delete(where={"path": str(p)})
-    st = load_state()
-    st.pop(str(p), None)
-    save_state(st)
+    with _INGEST_LOCK:
+        COLL.delete(where={"path": str(p)})
+        st = load_state()
+        st.pop(str(p), None)
+        save_state(st, [str(p)], force=True)
     return TextContent(text=f"Invalidated {path}")
 
 def run():
-    initial_scan()
+    # Load and warm the model while the scan walks the tree and extracts text
+    threading.Thread(target=lambda: get_model().encode(["warmup"]), daemon=True).start()
+    # Watch before scanning: a file saved mid-scan is dropped by prepare_file/flush_batch as changed,
+    # and only its watcher event brings it back
     obs = Observer()
-    obs.schedule(Handler(), str(ROOT), recursive=True)
+    obs.schedule(Handler().start(), str(ROOT), recursive=True)
     obs.start()
     try:
-        server.run_stdio()
+        initial_scan()
+        with contextlib.suppress(KeyboardInterrupt):
+            server.run_stdio()
     finally:
         obs.stop()
-        obs.join()
+        obs.join(timeout=5)
+        flush_state(load_state())
 
 if __name__ == "__main__":
     run()
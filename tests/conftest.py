@@ -45,3 +45,47 @@ def mock_env(monkeypatch, temp_dir):
 def sample_long_text():
     """Create a long text for chunking tests."""
     return "word " * 100  # 500 characters (100 words * 5 chars each)
+
+
+class _FakeModel:
+    """Minimal stand-in for SentenceTransformer that records encode calls."""
+
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, docs, **kwargs):
+        import numpy as np
+        self.calls.append(list(docs))
+        return np.array([[float(len(d)), 1.0] for d in docs], dtype=np.float32)
+
+
+class _FakeCollection:
+    """Minimal stand-in for a Chroma collection that records writes."""
+
+    def __init__(self):
+        self.added = []
+        self.deleted = []
+
+    def add(self, ids, embeddings, documents, metadatas):
+        self.added.append((list(ids), [list(e) for e in embeddings], list(documents)))
+
+    def delete(self, where=None, ids=None):
+        self.deleted.append(where)
+
+    def query(self, query_embeddings, n_results, where=None, include=()):
+        return {key: [self.hits[key]] for key in ("ids", *include)}
+
+    def get(self, ids, include=()):
+        self.fetched = list(ids)
+        docs = dict(zip(self.hits["ids"], self.hits["documents"]))
+        return {"ids": list(ids), "documents": [docs[i] for i in ids]}
+
+
+@pytest.fixture
+def fake_index(monkeypatch, tmp_path):
+    """Point mcp_server at a recording model and collection and a per-test state DB."""
+    model, coll = _FakeModel(), _FakeCollection()
+    monkeypatch.setattr("mcp_server.model", model)
+    monkeypatch.setattr("mcp_server.COLL", coll)
+    monkeypatch.setattr("mcp_server.STATE_PATH", tmp_path / "state.db")
+    return model, coll
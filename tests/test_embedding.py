@@ -0,0 +1,163 @@
+"""Tests for ingest/embedding.py module."""
+
+import numpy as np
+import pytest
+
+
+def test_embedding_module_imports():
+    """Test that embedding module can be imported."""
+    from ingest import embedding
+    assert hasattr(embedding, 'load_model')
+
+
+def test_mean_pool_ignores_padding():
+    """Test that padded positions do not contribute to the pooled vector."""
+    from ingest.embedding import _mean_pool
+
+    hidden = np.array([[[1.0, 2.0], [3.0, 4.0], [100.0, 100.0]]], dtype=np.float32)
+    mask = np.array([[1, 1, 0]])
+
+    pooled = _mean_pool(hidden, mask)
+
+    assert pooled.shape == (1, 2)
+    assert np.allclose(pooled[0], [2.0, 3.0])
+
+
+def test_mean_pool_all_masked():
+    """Test that a fully masked row does not divide by zero."""
+    from ingest.embedding import _mean_pool
+
+    hidden = np.ones((1, 2, 3), dtype=np.float32)
+    mask = np.zeros((1, 2))
+
+    pooled = _mean_pool(hidden, mask)
+    assert np.all(np.isfinite(pooled))
+
+
+@pytest.mark.parametrize("rows", [
+    [[3.0, 4.0]],
+    [[1.0, 0.0], [0.5, 0.5]],
+])
+def test_l2_normalize_unit_norm(rows):
+    """Test that normalized rows have unit length."""
+    from ingest.embedding import _l2_normalize
+
+    out = _l2_normalize(np.array(rows, dtype=np.float32))
+    assert np.allclose(np.linalg.norm(out, axis=1), 1.0)
+
+
+class _CountingModel:
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, texts, **kwargs):
+        self.calls.append(list(texts))
+        return np.array([[len(t), 1.0] for t in texts], dtype=np.float32)
+
+
+def test_vector_payload_round_trip():
+    """Test that vectors survive the embed server's base64 payload."""
+    from ingest.embedding import decode_vectors, encode_vectors
+
+    vecs = np.arange(6, dtype=np.float32).reshape(3, 2)
+    assert np.array_equal(decode_vectors(encode_vectors(vecs)), vecs)
+
+
+def test_dynamic_batcher_merges_concurrent_requests():
+    """Test that requests inside the batching window share one model call."""
+    import threading
+    from ingest.embedding import DynamicBatcher
+
+    model = _CountingModel()
+    batcher = DynamicBatcher(model, window_ms=200)
+    results = {}
+
+    def call(texts, normalize):
+        results[texts[0]] = batcher.encode(texts, normalize)
+
+    threads = [threading.Thread(target=call, args=(["a"], False)),
+               threading.Thread(target=call, args=(["bbb", "cc"], True))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert len(model.calls) == 1
+    assert np.array_equal(results["a"], [[1.0, 1.0]])
+    assert np.allclose(np.linalg.norm(results["bbb"], axis=1), 1.0)
+    assert results["bbb"].shape == (2, 2)
+
+
+def test_embed_server_round_trip():
+    """Test that RemoteEmbedder gets the server's vectors back."""
+    import threading
+    from embed_server import make_server
+    from ingest.embedding import DynamicBatcher, RemoteEmbedder
+
+    server = make_server(DynamicBatcher(_CountingModel(), window_ms=1), "127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        remote = RemoteEmbedder(f"http://127.0.0.1:{server.server_address[1]}")
+        vecs = remote.encode(["ab", "c"])
+        assert np.array_equal(vecs, [[2.0, 1.0], [1.0, 1.0]])
+        assert remote.encode("abc").shape == (2,)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_embed_server_reports_encode_failure():
+    """Test that a failing model yields an HTTP 500 rather than a dropped connection."""
+    import threading
+    import requests
+    from embed_server import make_server
+    from ingest.embedding import DynamicBatcher, RemoteEmbedder
+
+    class _BrokenModel:
+        def encode(self, texts, **kwargs):
+            raise RuntimeError("model offline")
+
+    server = make_server(DynamicBatcher(_BrokenModel(), window_ms=1), "127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        remote = RemoteEmbedder(f"http://127.0.0.1:{server.server_address[1]}")
+        with pytest.raises(requests.HTTPError) as exc:
+            remote.encode(["a"])
+        assert exc.value.response.status_code == 500
+        assert "model offline" in exc.value.response.text
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_embed_server_rejects_non_object_body():
+    """Test that a JSON body that is not an object gets a 400 rather than a dropped connection."""
+    import threading
+    import requests
+    from embed_server import make_server
+    from ingest.embedding import DynamicBatcher
+
+    server = make_server(DynamicBatcher(None, window_ms=1), "127.0.0.1", 0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}/embed"
+        for body in ([], "texts", 3):
+            assert requests.post(url, json=body, timeout=5).status_code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_remote_embedder_session_per_thread():
+    """Test that RemoteEmbedder does not share one requests.Session across threads."""
+    import threading
+    from ingest.embedding import RemoteEmbedder
+
+    remote = RemoteEmbedder("http://127.0.0.1:1")
+    other = []
+    t = threading.Thread(target=lambda: other.append(remote._session()))
+    t.start()
+    t.join()
+
+    assert remote._session() is remote._session()
+    assert other[0] is not remote._session()
@@ -82,7 +82,7 @@ def test_read_large_file(tmp_path):
     assert "Line of text" in result
 
 
-@pytest.mark.parametrize("extension", [".txt", ".md", ".log"])
+@pytest.mark.parametrize("extension", [".txt", ".md", ".log", ".csv", ".tsv"])
 def test_read_various_extensions(tmp_path, extension):
     """Test reading files with various text extensions."""
     from ingest.extractor import read_text_with_ocr
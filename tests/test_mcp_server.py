@@ -5,6 +5,8 @@ import json
 from pathlib import Path
 import pytest
 
+from .conftest import _FakeCollection, _FakeModel
+
 # Note: These tests focus on the pure functions that don't require heavy dependencies
 
 
@@ -85,7 +87,7 @@ def test_fhash_consistency(tmp_path):
     hash2 = fhash(test_file)
 
     assert hash1 == hash2
-    assert len(hash1) == 40  # SHA1 hex digest length
+    assert len(hash1) == 64  # SHA-256 hex digest length
 
 
 def test_fhash_different_content(tmp_path):
@@ -109,7 +111,7 @@ def test_load_state_empty(tmp_path, monkeypatch):
     from mcp_server import load_state
 
     # Point to non-existent state file
-    monkeypatch.setattr("mcp_server.STATE_PATH", tmp_path / "nonexistent.json")
+    monkeypatch.setattr("mcp_server.STATE_PATH", tmp_path / "nonexistent.db")
 
     state = load_state()
     assert state == {}
@@ -119,7 +121,7 @@ def test_save_and_load_state(tmp_path, monkeypatch):
     """Test saving and loading state."""
     from mcp_server import save_state, load_state
 
-    state_file = tmp_path / "state.json"
+    state_file = tmp_path / "state.db"
     monkeypatch.setattr("mcp_server.STATE_PATH", state_file)
 
     test_state = {
@@ -136,7 +138,7 @@ def test_save_and_load_state(tmp_path, monkeypatch):
 def test_state_path_created(tmp_path, monkeypatch):
     """Test that state directory is created if it doesn't exist."""
     state_dir = tmp_path / "new_dir"
-    state_file = state_dir / "state.json"
+    state_file = state_dir / "state.db"
 
     assert not state_dir.exists()
 
@@ -199,3 +201,821 @@ def test_chunk_text_various_sizes(size, overlap):
     for start, end, content in chunks[:-1]:  # Exclude last chunk (may be smaller)
         assert len(content) <= size
         assert end - start <= size
+
+
+def test_flush_batch_single_encode(tmp_path, fake_index):
+    """Test that chunks from several files are embedded in one encode call."""
+    import mcp_server
+
+    model, coll = fake_index
+
+    files = []
+    for name, content in [("a.txt", "short"), ("b.md", "a much longer document body")]:
+        f = tmp_path / name
+        f.write_text(content)
+        files.append(f)
+
+    state = {}
+    mcp_server.flush_batch([mcp_server.prepare_file(f) for f in files], state)
+
+    assert len(model.calls) == 1
+    assert len(coll.added) == 1
+    assert coll.deleted == [{"path": {"$in": [str(f) for f in files]}}]
+    # Each chunk gets back its own vector
+    for ids, embeddings, documents in coll.added:
+        assert [e[0] for e in embeddings] == [float(len(d)) for d in documents]
+    assert set(state) == {str(f) for f in files}
+
+
+def test_prepare_file_skips_empty(tmp_path):
+    """Test that empty files produce nothing to index."""
+    from mcp_server import prepare_file
+
+    f = tmp_path / "empty.txt"
+    f.write_text("   ")
+
+    _, ids, docs, metas, entry = prepare_file(f)
+    assert ids == docs == metas == []
+    assert "hash" in entry
+
+
+def test_embed_documents_sorted_and_restored(monkeypatch):
+    """Test that docs are encoded shortest-first and vectors come back in input order."""
+    import mcp_server
+
+    model = _FakeModel()
+    monkeypatch.setattr("mcp_server.model", model)
+
+    docs = ["ccc", "a", "bbbb", "dd"]
+    vecs = mcp_server.embed_documents(docs)
+
+    assert model.calls == [["a", "dd", "ccc", "bbbb"]]
+    assert [v[0] for v in vecs] == [float(len(d)) for d in docs]
+    assert vecs.dtype.name == "float32"
+
+
+def test_needs_reindex_unchanged_skips_hash(tmp_path, monkeypatch):
+    """Test that a matching (size, mtime_ns) signature avoids hashing the file."""
+    import mcp_server
+
+    f = tmp_path / "doc.txt"
+    f.write_text("content")
+    st = f.stat()
+    state = {str(f): {"hash": "abc", "size": st.st_size, "mtime_ns": st.st_mtime_ns}}
+
+    def fail(_):
+        raise AssertionError("fhash should not be called")
+
+    monkeypatch.setattr("mcp_server.fhash", fail)
+    assert mcp_server.needs_reindex(f, state) is False
+
+
+def test_touched_file_hashed_once_and_not_reembedded(tmp_path, monkeypatch, fake_index):
+    """Test that a touched file with identical content is hashed once, on the worker, and only
+    has its signature refreshed."""
+    import os
+    import mcp_server
+
+    model, coll = fake_index
+    f = tmp_path / "doc.txt"
+    f.write_text("content")
+    state = {str(f): {"hash": mcp_server.fhash(f), "algo": "sha256", "size": 0, "mtime_ns": 0}}
+    os.utime(f, ns=(1, 2))
+    hashed = []
+    real_fhash = mcp_server.fhash
+    monkeypatch.setattr("mcp_server.fhash", lambda p: hashed.append(p) or real_fhash(p))
+
+    def fail(_):
+        raise AssertionError("unchanged content should not be extracted")
+
+    monkeypatch.setattr("mcp_server.read_text", fail)
+    assert mcp_server.needs_reindex(f, state) is True
+    mcp_server.flush_batch(list(mcp_server.prepare_files([f], state)), state)
+
+    assert hashed == [f]
+    assert model.calls == [] and coll.added == [] and coll.deleted == []
+    assert state[str(f)]["mtime_ns"] == 2
+
+
+def test_needs_reindex_changed_and_new(tmp_path):
+    """Test that new or modified files are reported as needing reindex."""
+    from mcp_server import needs_reindex
+
+    f = tmp_path / "doc.txt"
+    f.write_text("content")
+
+    assert needs_reindex(f, {}) is True
+    assert needs_reindex(f, {str(f): {"hash": "stale", "size": 0, "mtime_ns": 0}}) is True
+
+
+def test_needs_reindex_other_algo(tmp_path):
+    """Test that a hash recorded with a different algorithm forces a re-check."""
+    from mcp_server import fhash, needs_reindex
+
+    f = tmp_path / "doc.txt"
+    f.write_text("content")
+    state = {str(f): {"hash": fhash(f), "algo": "sha1", "size": 0, "mtime_ns": 0}}
+
+    assert needs_reindex(f, state) is True
+
+
+@pytest.mark.parametrize("n,size,overlap", [
+    (0, 100, 20),
+    (10, 100, 20),
+    (300, 100, 20),
+    (1234, 100, 0),
+])
+def test_chunk_spans_match_chunk_text(n, size, overlap):
+    """Test that chunk_spans yields the same offsets chunk_text slices."""
+    from mcp_server import chunk_spans, chunk_text
+
+    text = "x" * n
+    spans = list(chunk_spans(n, size, overlap))
+
+    assert spans == [(a, b) for a, b, _ in chunk_text(text, size, overlap)]
+
+
+def test_prepare_files_preserves_order(tmp_path, monkeypatch):
+    """Test that parallel extraction yields results in input order."""
+    import mcp_server
+
+    monkeypatch.setattr("mcp_server.INGEST_WORKERS", 3)
+    files = []
+    for i in range(10):
+        f = tmp_path / f"doc{i}.txt"
+        f.write_text(f"document {i}")
+        files.append(f)
+
+    items = list(mcp_server.prepare_files(files))
+
+    assert [item[0] for item in items] == files
+
+
+def test_flush_batch_skips_file_changed_since_prepare(tmp_path, fake_index):
+    """Test that a prepared item is dropped when the file was saved again before the flush."""
+    import os
+
+    import mcp_server
+
+    model, coll = fake_index
+    old, kept = tmp_path / "old.txt", tmp_path / "kept.txt"
+    old.write_text("version one")
+    kept.write_text("unchanged")
+    items = [mcp_server.prepare_file(old), mcp_server.prepare_file(kept)]
+
+    # The watcher has meanwhile indexed a newer save; the queued v1 must not overwrite it
+    old.write_text("version two, longer")
+    os.utime(old, ns=(items[0][4]["mtime_ns"] + 10**9,) * 2)
+    state = {}
+    mcp_server.flush_batch(items, state)
+
+    assert coll.deleted == [{"path": {"$in": [str(kept)]}}]
+    assert [docs for _, _, docs in coll.added] == [["unchanged"]]
+    assert list(state) == [str(kept)]
+
+
+def test_flush_batch_splits_chroma_adds(tmp_path, monkeypatch, fake_index):
+    """Test that Chroma adds are issued in CHROMA_BATCH-sized slices across files."""
+    import mcp_server
+
+    _, coll = fake_index
+    monkeypatch.setattr("mcp_server.CHROMA_BATCH", 4)
+
+    items = []
+    for i in range(3):
+        f = tmp_path / f"doc{i}.txt"
+        f.write_text("y" * 10)
+        items.append((f, [f"{f}:{k}" for k in range(3)], ["y" * (k + 1) for k in range(3)],
+                      [{"path": str(f)}] * 3,
+                      {"hash": str(i), "size": f.stat().st_size, "mtime_ns": f.stat().st_mtime_ns}))
+
+    mcp_server.flush_batch(items, {})
+
+    assert [len(ids) for ids, _, _ in coll.added] == [4, 4, 1]
+
+
+def test_save_state_rows_persist(tmp_path, monkeypatch):
+    """Test that row-level saves reach SQLite and survive a cold reload."""
+    import mcp_server
+
+    monkeypatch.setattr("mcp_server.STATE_PATH", tmp_path / "state.db")
+    monkeypatch.setattr("mcp_server.STATE_FLUSH_EVERY", 1)
+    state = mcp_server.load_state()
+    state["a.txt"] = {"hash": "1"}
+    state["b.txt"] = {"hash": "2"}
+    mcp_server.save_state(state, ["a.txt", "b.txt"])
+
+    state.pop("a.txt")
+    state["b.txt"] = {"hash": "3"}
+    mcp_server.save_state(state, ["a.txt", "b.txt"])
+
+    mcp_server._STATE_CACHE.clear()
+    assert mcp_server.load_state() == {"b.txt": {"hash": "3"}}
+
+
+def test_handler_coalesces_event_burst(tmp_path, fake_index):
+    """Test that a burst of events on one path is indexed once after the quiet period."""
+    from types import SimpleNamespace
+    import mcp_server
+
+    model, coll = fake_index
+
+    f = tmp_path / "note.md"
+    f.write_text("draft")
+    handler = mcp_server.Handler()
+    for _ in range(5):
+        handler.on_any_event(SimpleNamespace(is_directory=False, src_path=str(f),
+                                             event_type="modified"))
+
+    handler.process_due(now=0.0)
+    assert model.calls == []
+
+    handler.process_due(now=1e12)
+    assert len(model.calls) == 1
+    assert len(coll.added) == 1
+
+
+def test_handler_ignores_open_and_close_events(tmp_path):
+    """Test that reads reported as opened/closed events do not queue the file for indexing."""
+    from types import SimpleNamespace
+    import mcp_server
+
+    f = tmp_path / "note.md"
+    f.write_text("draft")
+    handler = mcp_server.Handler()
+    for kind in ("opened", "closed", "closed_no_write"):
+        handler.on_any_event(SimpleNamespace(is_directory=False, src_path=str(f), event_type=kind))
+
+    assert handler._pending == {}
+
+
+def test_handler_retries_failing_path_alone(tmp_path, monkeypatch, fake_index):
+    """Test that one unreadable file is retried with backoff while the rest of its batch is indexed."""
+    import mcp_server
+
+    model, coll = fake_index
+    monkeypatch.setattr("mcp_server.DEBOUNCE_MS", 500)
+    monkeypatch.setattr("mcp_server.DEBOUNCE_MAX_MS", 4000)
+    good, bad = tmp_path / "good.md", tmp_path / "bad.md"
+    good.write_text("fine")
+    bad.write_text("locked")
+    state = mcp_server.load_state()
+    state[str(bad)] = {"hash": "old", "algo": mcp_server.HASH_ALGO, "size": 0, "mtime_ns": 0}
+    real_fhash = mcp_server.fhash
+
+    def fhash(p):
+        if p == bad:
+            raise PermissionError(str(p))
+        return real_fhash(p)
+
+    monkeypatch.setattr("mcp_server.fhash", fhash)
+    handler = mcp_server.Handler()
+    handler._pending = {str(bad): (10.0, 10.0), str(good): (10.0, 10.0)}
+    handler.process_due(now=20.0)
+
+    assert [docs for _, _, docs in coll.added] == [["fine"]]
+    assert list(handler._pending) == [str(bad)]
+    handler.process_due(now=23.9)
+    assert list(handler._pending) == [str(bad)]
+    # Due after DEBOUNCE_MAX_MS, then twice that after the second failure
+    handler.process_due(now=24.0)
+    assert handler._next_deadline() == 32.0
+
+    monkeypatch.setattr("mcp_server.fhash", real_fhash)
+    handler.process_due(now=32.0)
+    assert handler._pending == {} and handler._failures == {}
+    assert [docs for _, _, docs in coll.added] == [["fine"], ["locked"]]
+
+
+def test_handler_flushes_path_that_never_goes_quiet(tmp_path, monkeypatch, fake_index):
+    """Test that constant writes to a path are still indexed once DEBOUNCE_MAX_MS has passed."""
+    from types import SimpleNamespace
+    import mcp_server
+
+    model, coll = fake_index
+    monkeypatch.setattr("mcp_server.DEBOUNCE_MS", 500)
+    monkeypatch.setattr("mcp_server.DEBOUNCE_MAX_MS", 4000)
+    clock = [100.0]
+
+    f = tmp_path / "log.md"
+    f.write_text("growing")
+    handler = mcp_server.Handler(clock=lambda: clock[0])
+    event = SimpleNamespace(is_directory=False, src_path=str(f), event_type="modified")
+    while True:
+        handler.on_any_event(event)
+        if clock[0] >= 103.75:
+            break
+        clock[0] += 0.25
+
+    handler.process_due(now=103.9)
+    assert model.calls == []
+
+    handler.process_due(now=104.1)
+    assert len(model.calls) == 1
+
+
+def test_embed_query_cached(monkeypatch):
+    """Test that repeated queries reuse the cached query embedding."""
+    import mcp_server
+
+    model = _FakeModel()
+    monkeypatch.setattr("mcp_server.model", model)
+    mcp_server._embed_query.cache_clear()
+
+    first = mcp_server._embed_query("model-a", "invoice policy")
+    second = mcp_server._embed_query("model-a", "invoice policy")
+    mcp_server._embed_query("model-b", "invoice policy")
+
+    assert first is second
+    assert len(model.calls) == 2
+    mcp_server._embed_query.cache_clear()
+
+
+def test_fhash_matches_hashlib(tmp_path):
+    """Test that the buffered hash equals a plain hashlib digest, including empty files."""
+    import hashlib
+    from mcp_server import fhash
+
+    for name, data in [("empty.txt", b""), ("big.bin", b"0123456789" * 300_000),
+                       ("multi.bin", bytes(range(256)) * 40_000)]:
+        f = tmp_path / name
+        f.write_bytes(data)
+        assert fhash(f) == hashlib.sha256(data).hexdigest()
+
+
+def test_prepare_file_leaves_text_cache_alone(tmp_path):
+    """Test that scanning does not keep whole extracted documents in the read_text cache."""
+    import mcp_server
+
+    mcp_server._read_text_cached.cache_clear()
+    for i in range(3):
+        f = tmp_path / f"doc{i}.md"
+        f.write_text("body " * 100)
+        assert mcp_server.prepare_file(f)[2]
+
+    assert mcp_server._read_text_cached.cache_info().currsize == 0
+
+
+def test_read_text_cached_reuses_until_changed(tmp_path, monkeypatch):
+    """Test that extracted text is reused until the file's size/mtime change."""
+    import os
+    import mcp_server
+
+    calls = []
+
+    def fake_read(p):
+        calls.append(p)
+        return p.read_text()
+
+    monkeypatch.setattr("mcp_server.read_text", fake_read)
+    mcp_server._read_text_cached.cache_clear()
+
+    f = tmp_path / "doc.txt"
+    f.write_text("v1")
+    assert mcp_server.read_text_cached(f) == "v1"
+    assert mcp_server.read_text_cached(f) == "v1"
+    assert len(calls) == 1
+
+    f.write_text("v2!")
+    os.utime(f, ns=(1, 1))
+    assert mcp_server.read_text_cached(f) == "v2!"
+    assert len(calls) == 2
+    mcp_server._read_text_cached.cache_clear()
+
+
+def test_chunk_spans_matches_reference_loop():
+    """Test closed-form spans against the original while-loop chunker."""
+    from mcp_server import chunk_spans
+
+    def reference(n, size, overlap):
+        out, i = [], 0
+        while i < n:
+            j = min(n, i + size)
+            out.append((i, j))
+            if j == n:
+                break
+            i = j - overlap
+        return out
+
+    for n in [0, 1, 99, 100, 101, 180, 181, 1000, 3001]:
+        for size, overlap in [(100, 0), (100, 20), (100, 99), (7, 3)]:
+            assert list(chunk_spans(n, size, overlap)) == reference(n, size, overlap)
+
+
+def test_chunk_spans_rejects_overlap_ge_size():
+    """Test that an overlap that would never advance raises instead of looping."""
+    from mcp_server import chunk_spans
+
+    with pytest.raises(ValueError):
+        list(chunk_spans(10, 5, 5))
+
+
+def test_overlap_ge_size_rejected_at_import(tmp_path):
+    """Test that a misconfigured CHUNK_OVERLAP stops the server at startup, not mid-scan."""
+    import os
+    import subprocess
+    import sys
+
+    repo = Path(__file__).resolve().parent.parent
+    env = dict(os.environ, CHUNK_SIZE="500", CHUNK_OVERLAP="500",
+               PYTHONPATH=os.pathsep.join(filter(None, [str(repo), os.environ.get("PYTHONPATH")])))
+    proc = subprocess.run([sys.executable, "-c", "import mcp_server"], cwd=tmp_path, env=env,
+                          capture_output=True, text=True)
+
+    assert proc.returncode != 0
+    assert "CHUNK_OVERLAP (500) must be smaller than CHUNK_SIZE (500)" in proc.stderr
+
+
+def test_rag_search_ranks_by_blended_score(monkeypatch):
+    """Test that lexical matches can outrank closer vectors after blending."""
+    import mcp_server
+
+    coll = _FakeCollection()
+    coll.hits = {
+        "ids": ["a:0-5", "b:0-5"],
+        "documents": ["zzzzz", "invoice policy"],
+        "metadatas": [{"path": "a", "start": 0, "end": 5}, {"path": "b", "start": 0, "end": 5}],
+        "distances": [0.10, 0.12],
+    }
+    monkeypatch.setattr("mcp_server.COLL", coll)
+    monkeypatch.setattr("mcp_server.model", _FakeModel())
+    mcp_server._embed_query.cache_clear()
+
+    res = json.loads(mcp_server.rag_search("invoice policy", k=2).text)
+
+    assert [r["path"] for r in res["results"]] == ["b", "a"]
+    assert res["results"][0]["score"] > res["results"][1]["score"]
+    # Exact value: 0.8 * (1 - 0.12) + 0.2 * 1.0, rounded to 4 places without float32 noise
+    assert res["results"][0]["score"] == 0.904
+    mcp_server._embed_query.cache_clear()
+
+
+def test_chunk_heads_reads_unchanged_text_from_disk(tmp_path, monkeypatch):
+    """Test that plain-text hits skip Chroma while stale or binary hits fall back to it."""
+    import mcp_server
+
+    f = tmp_path / "notes.md"
+    f.write_text("0123456789")
+    coll = _FakeCollection()
+    coll.hits = {"ids": ["stale", "pdf"], "documents": ["from chroma", "pdf text"]}
+    monkeypatch.setattr("mcp_server.COLL", coll)
+    fresh = mcp_server.prepare_file(f)[3][0]
+    stale = dict(fresh, mtime_ns=fresh["mtime_ns"] - 1)
+    pdf = {"path": str(tmp_path / "doc.pdf"), "start": 0, "end": 8, "mtime": 0, "mtime_ns": 0}
+
+    heads = mcp_server.chunk_heads(["fresh", "stale", "pdf"], [fresh, stale, pdf])
+
+    assert heads == ["0123456789", "from chroma", "pdf text"]
+    assert coll.fetched == ["stale", "pdf"]
+
+
+def test_chunk_heads_reads_only_the_needed_prefix(tmp_path, monkeypatch):
+    """Test that a disk preview matches the chunk text without extracting or caching the whole file."""
+    import mcp_server
+
+    f = tmp_path / "long.md"
+    f.write_text("".join(f"line {i}\r\n" for i in range(2000)))
+    monkeypatch.setattr("mcp_server.COLL", _FakeCollection())
+    _, _, docs, metas, _ = mcp_server.prepare_file(f)
+    mcp_server._read_text_cached.cache_clear()
+
+    heads = mcp_server.chunk_heads([str(i) for i in range(len(metas))], metas, n=100)
+
+    assert len(metas) > 2
+    assert heads == [d[:100] for d in docs]
+    assert mcp_server._read_text_cached.cache_info().currsize == 0
+
+
+def test_get_model_loads_once(monkeypatch):
+    """Test that the embedding model is built lazily and only once."""
+    import mcp_server
+
+    loads = []
+    monkeypatch.setattr("mcp_server.model", None)
+    monkeypatch.setattr("mcp_server.load_model", lambda name: loads.append(name) or _FakeModel())
+
+    first = mcp_server.get_model()
+
+    assert mcp_server.get_model() is first
+    assert loads == [mcp_server.EMBED_MODEL]
+
+
+def test_save_state_defers_rows_until_flush(tmp_path, monkeypatch):
+    """Test that row saves are queued until STATE_FLUSH_EVERY paths or an explicit flush."""
+    import mcp_server
+
+    monkeypatch.setattr("mcp_server.STATE_PATH", tmp_path / "state.db")
+    monkeypatch.setattr("mcp_server.STATE_FLUSH_EVERY", 3)
+    state = mcp_server.load_state()
+
+    def rows():
+        return mcp_server._state_db().execute("SELECT COUNT(*) FROM state").fetchone()[0]
+
+    for name in ("a.txt", "b.txt"):
+        state[name] = {"hash": name}
+        mcp_server.save_state(state, [name])
+    assert rows() == 0
+
+    state["c.txt"] = {"hash": "c"}
+    mcp_server.save_state(state, ["c.txt"])
+    assert rows() == 3
+
+    state["d.txt"] = {"hash": "d"}
+    mcp_server.save_state(state, ["d.txt"])
+    mcp_server.flush_state(state)
+    assert rows() == 4
+
+
+def test_flush_state_without_changes_skips_sqlite(tmp_path, monkeypatch):
+    """Test that flushing with nothing queued does not open the state database."""
+    import mcp_server
+
+    monkeypatch.setattr("mcp_server.STATE_PATH", tmp_path / "state.db")
+    mcp_server.flush_state({})
+
+    assert not (tmp_path / "state.db").exists()
+
+
+def test_batched_upserter_commits_state_once(tmp_path, fake_index):
+    """Test that a scan over several small files costs one encode, one add and one state commit."""
+    import mcp_server
+
+    model, coll = fake_index
+    statements = []
+    mcp_server._state_db().set_trace_callback(statements.append)
+
+    state = mcp_server.load_state()
+    with mcp_server.BatchedUpserter(state) as batch:
+        for i in range(5):
+            f = tmp_path / f"note{i}.txt"
+            f.write_text(f"note number {i}")
+            batch.add(mcp_server.prepare_file(f))
+
+    assert len(model.calls) == 1
+    assert len(coll.added) == 1
+    assert statements.count("COMMIT") == 1
+    assert len(state) == 5
+
+
+def test_iter_files_filters_by_extension(tmp_path, monkeypatch):
+    """Test that the scandir walker recurses and keeps only ALLOWED extensions."""
+    import mcp_server
+
+    monkeypatch.setattr("mcp_server.ALLOWED", {".md", ".txt"})
+    (tmp_path / "sub" / "deeper").mkdir(parents=True)
+    for rel in ["a.md", "b.PDF", "sub/c.TXT", "sub/deeper/d.md", "sub/deeper/e.py"]:
+        (tmp_path / rel).write_text("x")
+
+    found = {p.relative_to(tmp_path).as_posix() for p in mcp_server.iter_files(tmp_path)}
+
+    assert found == {"a.md", "sub/c.TXT", "sub/deeper/d.md"}
+
+
+def test_iter_files_skips_symlinks_out_of_root(tmp_path, monkeypatch):
+    """Test that symlinked files are followed only when they resolve inside the walked root."""
+    import mcp_server
+
+    monkeypatch.setattr("mcp_server.ALLOWED", {".md"})
+    root, outside = tmp_path / "root", tmp_path / "outside"
+    root.mkdir()
+    outside.mkdir()
+    (root / "real.md").write_text("x")
+    (outside / "secret.md").write_text("x")
+    (root / "inner.md").symlink_to(root / "real.md")
+    (root / "escape.md").symlink_to(outside / "secret.md")
+
+    found = {p.name for p in mcp_server.iter_files(root)}
+
+    assert found == {"real.md", "inner.md"}
+
+
+def test_inside_root_only_rejects_escaping_symlinks(tmp_path, monkeypatch):
+    """Test the watcher's containment check against the precomputed root prefix."""
+    import mcp_server
+
+    root, outside = tmp_path / "root", tmp_path / "outside"
+    root.mkdir()
+    outside.mkdir()
+    monkeypatch.setattr("mcp_server.ROOT_PREFIX", str(root) + os.sep)
+    (root / "a.md").write_text("x")
+    (outside / "b.md").write_text("x")
+    (root / "link_in.md").symlink_to(root / "a.md")
+    (root / "link_out.md").symlink_to(outside / "b.md")
+
+    assert mcp_server.inside_root(root / "a.md")
+    assert mcp_server.inside_root(root / "link_in.md")
+    assert not mcp_server.inside_root(root / "link_out.md")
+
+
+@pytest.mark.parametrize("name,expected", [
+    ("notes.md", True),
+    ("REPORT.PDF", True),
+    ("archive.tar.md", True),
+    ("notes.md.bak", False),
+    (".md", False),
+    ("README", False),
+])
+def test_allowed_name_matches_suffix_rules(name, expected, monkeypatch):
+    """Test the rfind extension check agrees with Path.suffix semantics."""
+    import mcp_server
+
+    monkeypatch.setattr("mcp_server.ALLOWED", frozenset({".md", ".pdf"}))
+
+    assert mcp_server.allowed_name(name) is expected
+    assert (Path(name).suffix.lower() in mcp_server.ALLOWED) is expected
+
+
+def test_prepare_file_ids_short_and_unique(tmp_path):
+    """Test that chunk ids are fixed-width path hashes plus the chunk start, unique per file."""
+    import mcp_server
+
+    deep = tmp_path / ("d" * 80)
+    deep.mkdir()
+    a, b = deep / "a.txt", deep / "b.txt"
+    a.write_text("x" * 7000)
+    b.write_text("x" * 7000)
+
+    ids_a = mcp_server.prepare_file(a)[1]
+    ids_b = mcp_server.prepare_file(b)[1]
+
+    assert len(set(ids_a) | set(ids_b)) == len(ids_a) + len(ids_b)
+    assert all(len(i.split(":")[0]) == 16 and str(tmp_path) not in i for i in ids_a)
+
+
+def test_unindexable_file_not_extracted_again(tmp_path, monkeypatch, fake_index):
+    """Test that a file yielding no text is recorded, so unchanged it is skipped by later scans."""
+    import mcp_server
+
+    model, coll = fake_index
+    f = tmp_path / "scan.pdf"
+    f.write_bytes(b"%PDF-1.4 not really")
+    monkeypatch.setattr("mcp_server.read_text", lambda p: "")
+
+    state = {}
+    mcp_server.flush_batch([mcp_server.prepare_file(f)], state)
+
+    assert model.calls == [] and coll.added == []
+    assert mcp_server.needs_reindex(f, state) is False
+
+    # A different OCR setting can turn the blank scan into text
+    monkeypatch.setattr("mcp_server.USE_OCR", not mcp_server.USE_OCR)
+    assert mcp_server.needs_reindex(f, state) is True
+
+
+def test_failed_extraction_not_recorded(tmp_path, monkeypatch):
+    """Test that an extraction error leaves the file unrecorded so the next scan retries it."""
+    import mcp_server
+
+    f = tmp_path / "scan.pdf"
+    f.write_bytes(b"%PDF-1.4 not really")
+
+    def boom(p):
+        raise RuntimeError("OCR endpoint down")
+
+    monkeypatch.setattr("mcp_server.read_text", boom)
+
+    with pytest.raises(RuntimeError):
+        mcp_server.prepare_file(f)
+    # A scan skips it without recording anything
+    assert list(mcp_server.prepare_files([f])) == [None]
+
+
+def test_handler_waits_for_running_ingest(tmp_path, fake_index):
+    """Test that a watcher batch does not embed or write while another flush holds the ingest lock."""
+    import threading
+    from types import SimpleNamespace
+    import mcp_server
+
+    model, coll = fake_index
+    f = tmp_path / "note.md"
+    f.write_text("draft")
+    handler = mcp_server.Handler()
+    handler.on_any_event(SimpleNamespace(is_directory=False, src_path=str(f), event_type="modified"))
+
+    with mcp_server._INGEST_LOCK:
+        t = threading.Thread(target=handler.process_due, kwargs={"now": 1e12})
+        t.start()
+        t.join(timeout=0.2)
+        assert t.is_alive() and model.calls == []
+    t.join()
+    assert len(model.calls) == 1
+
+
+def test_handler_next_deadline(monkeypatch):
+    """Test that the watcher sleeps until the earliest quiet or max-wait deadline, or indefinitely."""
+    import mcp_server
+
+    monkeypatch.setattr("mcp_server.DEBOUNCE_MS", 500)
+    monkeypatch.setattr("mcp_server.DEBOUNCE_MAX_MS", 5000)
+    handler = mcp_server.Handler()
+    assert handler._next_deadline() is None
+
+    handler._pending = {"a.md": (10.0, 14.8), "b.md": (12.0, 12.0)}
+    assert handler._next_deadline() == pytest.approx(12.5)
+
+    handler._pending = {"a.md": (10.0, 14.8)}
+    assert handler._next_deadline() == pytest.approx(15.0)
+
+
+def test_handler_sweeps_only_once_started(tmp_path, fake_index):
+    """Test that a Handler indexes on its own only after start(), so tests drive process_due alone."""
+    import threading
+    import time
+    from types import SimpleNamespace
+    import mcp_server
+
+    model, coll = fake_index
+    f = tmp_path / "note.md"
+    f.write_text("draft")
+    clock = [100.0]
+    before = threading.active_count()
+    handler = mcp_server.Handler(clock=lambda: clock[0])
+    assert threading.active_count() == before
+
+    handler.start()
+    handler.on_any_event(SimpleNamespace(is_directory=False, src_path=str(f), event_type="modified"))
+    clock[0] = 200.0
+    deadline = time.monotonic() + 5
+    while not coll.added and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert [docs for _, _, docs in coll.added] == [["draft"]]
+
+
+def test_prepare_file_drops_file_saved_mid_extraction(tmp_path, monkeypatch):
+    """Test that a save during extraction does not pair the new hash with the old text."""
+    import mcp_server
+
+    f = tmp_path / "note.md"
+    f.write_text("v1")
+
+    def extract_then_save(p):
+        txt = p.read_text()
+        p.write_text("version two")
+        return txt
+
+    monkeypatch.setattr("mcp_server.read_text", extract_then_save)
+
+    assert mcp_server.prepare_file(f) is None
+
+
+def test_run_watches_before_initial_scan(monkeypatch):
+    """Test that the observer is running before the startup scan, so saves during the scan are seen."""
+    import mcp_server
+
+    calls = []
+
+    class _Observer:
+        def schedule(self, handler, path, recursive):
+            calls.append("schedule")
+
+        def start(self):
+            calls.append("watch")
+
+        def stop(self):
+            calls.append("stop")
+
+        def join(self, timeout=None):
+            pass
+
+    monkeypatch.setattr("mcp_server.Observer", _Observer)
+    monkeypatch.setattr("mcp_server.get_model", _FakeModel)
+    monkeypatch.setattr("mcp_server.Handler.start", lambda self: self)
+    monkeypatch.setattr("mcp_server.initial_scan", lambda: calls.append("scan"))
+    monkeypatch.setattr("mcp_server.server.run_stdio", lambda: calls.append("serve"))
+    monkeypatch.setattr("mcp_server.flush_state", lambda s: None)
+    mcp_server.run()
+
+    assert calls == ["schedule", "watch", "scan", "serve", "stop"]
+
+
+def test_open_collection_keeps_existing_hnsw_settings(caplog):
+    """Test that an existing collection is opened as is, with a warning when its HNSW settings differ."""
+    from types import SimpleNamespace
+    import mcp_server
+
+    class _Client:
+        def __init__(self, *colls):
+            self.colls, self.created = list(colls), []
+
+        def list_collections(self):
+            return self.colls
+
+        def create_collection(self, name, metadata):
+            self.created.append((name, metadata))
+            return SimpleNamespace(name=name, metadata=metadata)
+
+    fresh = _Client()
+    assert mcp_server.open_collection(fresh, "docs").metadata == mcp_server.HNSW_PARAMS
+    assert fresh.created == [("docs", mcp_server.HNSW_PARAMS)]
+
+    same = SimpleNamespace(name="docs", metadata=dict(mcp_server.HNSW_PARAMS))
+    with caplog.at_level("WARNING", logger="mcp_server"):
+        assert mcp_server.open_collection(_Client(same), "docs") is same
+    assert caplog.records == []
+
+    old = SimpleNamespace(name="docs", metadata={"hnsw:space": "cosine"})
+    client = _Client(old)
+    with caplog.at_level("WARNING", logger="mcp_server"):
+        assert mcp_server.open_collection(client, "docs") is old
+    assert client.created == [] and old.metadata == {"hnsw:space": "cosine"}
+    assert "'hnsw:search_ef': 10" in caplog.text
@@ -151,3 +151,27 @@ def test_engine_environment_variable(engine, monkeypatch):
     monkeypatch.setattr('ingest.ocr.ENGINE', engine.lower())
 
     assert ingest.ocr.ENGINE == engine.lower()
+
+
+def test_session_reused_per_thread():
+    """Test that OCR HTTP calls reuse one keep-alive session per thread."""
+    import threading
+    from ingest.ocr import _session
+
+    other = []
+    t = threading.Thread(target=lambda: other.append(_session()))
+    t.start()
+    t.join()
+
+    assert _session() is _session()
+    assert other[0] is not _session()
+
+
+def test_deepseek_requires_url(monkeypatch):
+    """Test that an unset DeepSeek endpoint fails loudly instead of posting to None."""
+    from ingest import ocr
+
+    monkeypatch.setattr('ingest.ocr.DEEPSEEK_OCR_URL', None)
+
+    with pytest.raises(RuntimeError, match="DEEPSEEK_OCR_URL"):
+        ocr.ocr_deepseek([Image.new('RGB', (10, 10))])